@@ -234,6 +234,8 @@ class TaxonEncoder:
     def __init__(self, data):
         self.lvl_encoders = self.initialize_labels(data.data)
         self.inference_matrices = self.initialize_inference_matrices() # Empty
+        self.flat_offsets = [sum(self.classes[:lvl]) for lvl in range(6)]
+        self.flat_cap = sum(self.classes)
         self.train = True
 
     def initialize_labels(self, data):
@@ -305,7 +307,8 @@ class TaxonEncoder:
         decoding = []
         for i, l in enumerate(levels):
             l = utils.LEVELS.index(l)
-            decoding.append(self.lvl_encoders[l].inverse_transform(labels[:,i]))
+            # Gather class names directly, avoids inverse_transform overhead
+            decoding.append(self.lvl_encoders[l].classes_[labels[:,i]])
         decoding = np.stack(decoding,axis=1)
         return decoding
     
@@ -336,5 +339,7 @@ class TaxonEncoder:
 
     def flat_label(self, y, lvl):
         '''Maps y from specified level to unique number for ALL levels.'''
-        return torch.minimum(torch.full_like(y, sum(self.classes)), 
-                             y + sum(self.classes[:lvl]))
\ No newline at end of file
+        if not hasattr(self, 'flat_offsets'): # For encoders from old pickles
+            self.flat_offsets = [sum(self.classes[:l]) for l in range(6)]
+            self.flat_cap = sum(self.classes)
+        return (y + self.flat_offsets[lvl]).clamp(max=self.flat_cap)
\ No newline at end of file
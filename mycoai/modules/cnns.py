@@ -53,7 +53,7 @@ class ResNet(torch.nn.Module):
         self.layer1 = self._make_layer(block, 128, layers[1], stride=2)
         self.layer2 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer3 = self._make_layer(block, 512, layers[3], stride=2)
-        self.avgpool = torch.nn.AvgPool1d(7, stride=1)
+        self.avgpool = torch.nn.AdaptiveAvgPool1d(1)
         self.layers = layers
         
     def _make_layer(self, block, planes, blocks, stride=1):
@@ -80,7 +80,7 @@ class ResNet(torch.nn.Module):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = torch.flatten(x, 1)
         return x
 
     def get_config(self):
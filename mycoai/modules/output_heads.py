@@ -70,26 +70,67 @@ class InferSum(torch.nn.Module):
     
 
 class MultiHead(torch.nn.Module):
-    '''Predicting multiple taxon levels using different heads.'''
+    '''Predicting multiple taxon levels using different heads. The per-level
+    heads are stored in one fused linear layer, such that all levels are
+    served by a single matmul instead of six small ones.'''
 
     def __init__(self, classes, max_level='species'):
         super().__init__()
-        self.max_level = utils.LEVELS.index(max_level) 
-        self.output = torch.nn.ModuleList(
-            [torch.nn.LazyLinear(out_features=classes[i]) 
-             for i in range(self.max_level+1)])
-        self.softmax = torch.nn.ModuleList(
-            [torch.nn.Softmax(dim=1) for i in range(self.max_level+1)])
+        self.max_level = utils.LEVELS.index(max_level)
+        sizes = [int(classes[i]) for i in range(self.max_level+1)]
+        # Start/end columns of each level within the fused output
+        self.bounds = [sum(sizes[:i]) for i in range(len(sizes)+1)]
+        self.output = torch.nn.LazyLinear(out_features=sum(sizes))
+        self.softmax = torch.nn.Softmax(dim=1)
         self.classes = classes
-    
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if type(self.output) == torch.nn.ModuleList: # Pre-fusion legacy layout
+            self._fuse_legacy_heads()
+
+    def _fuse_legacy_heads(self):
+        '''Losslessly migrates the legacy layout (models pickled when this
+        head still used one linear layer per level) into the fused layer.'''
+
+        heads = self.output
+        sizes = [head.out_features for head in heads]
+        self.bounds = [sum(sizes[:i]) for i in range(len(sizes)+1)]
+        self.softmax = torch.nn.Softmax(dim=1)
+        if any(isinstance(head, torch.nn.modules.lazy.LazyModuleMixin) and
+               head.has_uninitialized_params() for head in heads):
+            # No trained weights to migrate yet
+            self.output = torch.nn.LazyLinear(out_features=sum(sizes))
+            return
+        fused = torch.nn.Linear(heads[0].in_features, sum(sizes))
+        fused = fused.to(heads[0].weight.device)
+        with torch.no_grad():
+            fused.weight.copy_(torch.cat([head.weight for head in heads]))
+            fused.bias.copy_(torch.cat([head.bias for head in heads]))
+        self.output = fused
+
     def forward(self, x, levels=range(6)):
+        levels = list(levels)
+        zeros = lambda lvl: torch.zeros((x.shape[0], self.classes[lvl]),
+                                        device=x.device)
+
+        if len(levels) == 6: # One fused matmul serves all levels
+            logits = self.output(x)
+            return [self.softmax(logits[:,self.bounds[lvl]:self.bounds[lvl+1]])
+                    if lvl <= self.max_level else zeros(lvl) for lvl in levels]
+
+        # Per-level calls (e.g. decoder loop) use a slice of the fused weights
+        if isinstance(self.output, torch.nn.modules.lazy.LazyModuleMixin):
+            self.output(x) # Materialize fused layer upon first call
         outputs = []
         for lvl in levels:
             if lvl > self.max_level: # Zeros if above max_level
-                outputs.append(torch.zeros((x.shape[0], self.classes[lvl]), 
-                                           device=x.device))
+                outputs.append(zeros(lvl))
             else:
-                outputs.append(self.softmax[lvl](self.output[lvl](x)))
+                start, end = self.bounds[lvl], self.bounds[lvl+1]
+                outputs.append(self.softmax(torch.nn.functional.linear(
+                    x, self.output.weight[start:end], self.output.bias[start:end]
+                )))
 
         return outputs
     
@@ -181,58 +222,84 @@ class ChainedMultiHead(torch.nn.Module):
     
     
 class SoftmaxTreeNode(torch.nn.Module):
-    ''''Node of a hierarchical softmax tree.'''
-
-    def __init__(self, parent, childs, root, lvl):
-        super().__init__()      
-        
-        # Finding subtrees
-        if lvl < 5: # Species-level:
-            subtrees = [SoftmaxTreeNode(child, root.find_children(child,lvl),
-                        root, lvl+1) for child in childs]
-            root.subtrees[lvl].append(torch.nn.ModuleList(subtrees)) 
-        
-        # Setting attributes
-        self.generator = utils.Generator(root.input_dim, len(childs))
-        self.parent = parent # Save class indices 
-        self.child_encodings = childs # (= TaxonEncoder encodings)
+    ''''Node of a hierarchical softmax tree. Kept only so that models saved
+    before SoftmaxTree was vectorized can be unpickled, after which
+    SoftmaxTree._fuse_legacy_nodes migrates them to the fused layout.'''
 
-    def forward(self, x): 
+    def forward(self, x):
         return self.generator(x)
-    
 
-class SoftmaxTree(SoftmaxTreeNode):
-    '''Root node of a hierarchical softmax tree. Output per class is the
-    conditional probability given the parent, multiplied by the probability of
-    the parent.'''
+
+class SoftmaxTree(torch.nn.Module):
+    '''Hierarchical softmax tree. Output per class is the conditional
+    probability given the parent, multiplied by the probability of the parent.
+    Uses one linear layer per level, normalizing the resulting scores per group
+    of sibling classes (classes that share the same parent).'''
 
     def __init__(self, classes, tax_encoder, input_dim):
+        super().__init__()
         self.tax_encoder = tax_encoder
         self.classes = classes
         self.input_dim = input_dim
-        self.subtrees = [[] for i in range(5)]
-        # Root is special instance of SoftmaxTreeNode
-        super().__init__(None, torch.arange(classes[0]), self, 0)
-        # Convert subtrees to module lists
-        for i in range(5):
-            self.subtrees[i] = torch.nn.ModuleList(self.subtrees[i])
-        self.subtrees = torch.nn.ModuleList(self.subtrees)
-
-    def find_children(self, parent, lvl):
-        inference_matrix = self.tax_encoder.inference_matrices[lvl]
-        max_probs = torch.argmax(inference_matrix, dim=1)
-        adj_matrix = torch.zeros(inference_matrix.shape)
-        adj_matrix[torch.arange(inference_matrix.shape[0]), max_probs] = 1
-        return torch.nonzero(adj_matrix[:,parent]).squeeze(1)
+        self.generator = utils.Generator(input_dim, classes[0]) # Root
+        if input_dim is None:
+            self.linears = torch.nn.ModuleList(
+                [torch.nn.LazyLinear(out_features=classes[lvl])
+                 for lvl in range(1,6)])
+        else:
+            self.linears = torch.nn.ModuleList(
+                [torch.nn.Linear(input_dim, classes[lvl])
+                 for lvl in range(1,6)])
+        # Parent class index per child class, per level
+        self.parents = [torch.argmax(matrix, dim=1)
+                        for matrix in tax_encoder.inference_matrices]
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if hasattr(self, 'subtrees'): # Pre-vectorization legacy layout
+            self._fuse_legacy_nodes()
+
+    def _fuse_legacy_nodes(self):
+        '''Losslessly migrates the legacy layout (models pickled when this
+        head still used one Generator module per taxon node) into the fused
+        per-level linear layers.'''
+
+        example = self.subtrees[0][0][0].generator.linear
+        if isinstance(example, torch.nn.modules.lazy.LazyModuleMixin):
+            raise RuntimeError('Cannot migrate legacy SoftmaxTree head with '
+                               'uninitialized layers, recreate the model.')
+        in_features = example.weight.shape[1]
+        device = example.weight.device
+        linears = []
+        with torch.no_grad():
+            for lvl in range(5): # Scatter node weights into per-level layers
+                linear = torch.nn.Linear(in_features,
+                                         int(self.classes[lvl+1])).to(device)
+                for parent in self.subtrees[lvl]:
+                    for node in parent:
+                        childs = node.child_encodings
+                        linear.weight[childs] = node.generator.linear.weight
+                        linear.bias[childs] = node.generator.linear.bias
+                linears.append(linear)
+        del self.subtrees
+        self.linears = torch.nn.ModuleList(linears)
+        self.parents = [torch.argmax(matrix, dim=1)
+                        for matrix in self.tax_encoder.inference_matrices]
 
     def forward(self, x):
         full_output = [self.generator(x)]
         for lvl in range(1,6):
-            output = torch.zeros(x.shape[0], self.classes[lvl], 
-                                 device=utils.DEVICE)
-            for parent in self.subtrees[lvl-1]:
-                for subtree in parent:
-                    prob = full_output[lvl-1][:,subtree.parent].view(-1,1)
-                    output[:,subtree.child_encodings] = prob * subtree(x)  
-            full_output.append(output)
+            logits = self.linears[lvl-1](x)
+            parents = self.parents[lvl-1]
+            # Softmax per group of siblings (classes sharing their parent),
+            # subtracting the per-group max for numerical stability
+            group_max = torch.full((x.shape[0], int(self.classes[lvl-1])),
+                                   float('-inf'), device=logits.device,
+                                   dtype=logits.dtype)
+            group_max.index_reduce_(1, parents, logits, 'amax')
+            exp = torch.exp(logits - group_max[:,parents])
+            sums = torch.zeros_like(full_output[lvl-1])
+            sums = sums.index_add(1, parents, exp)
+            cond_probs = exp / (sums[:,parents] + 1e-7)
+            full_output.append(cond_probs * full_output[lvl-1][:,parents])
         return full_output
\ No newline at end of file
@@ -13,9 +13,9 @@ class SeqClassNetwork(torch.nn.Module):
     class that stores encoder objects and adds an output layer as well as other 
     application-related functionalities to a base architecture.'''
 
-    def __init__(self, base_arch, dna_encoder, tax_encoder, fcn_layers=[], 
+    def __init__(self, base_arch, dna_encoder, tax_encoder, fcn_layers=[],
                  dropout=0, output='multi', max_level='species',
-                 chained_config=[False,True,True]):
+                 chained_config=[False,True,True], compile_model=False):
         '''Creates network based on specified archticture and encoders
 
         Parameters
@@ -38,7 +38,11 @@ class SeqClassNetwork(torch.nn.Module):
         chained_config: list[bool]
             List of length 3 indicating the configuration for ChainedMultiHead.
             Corresponding to arguments: ascending, use_probs, and all_access.
-            Default is [False, True, True].'''
+            Default is [False, True, True].
+        compile_model: bool
+            Whether to optimize the forward pass with torch.compile, reducing
+            kernel launch overhead during inference. Not supported for
+            EncoderDecoder base architectures (default is False).'''
         
         super().__init__()
         self.dna_encoder = dna_encoder
@@ -48,6 +52,7 @@ class SeqClassNetwork(torch.nn.Module):
         self.base_arch = base_arch
         self.dropout = torch.nn.Dropout(dropout)
         self.masked_levels = []
+        self._masked_idx = []
         
         if type(self.base_arch) == BERT:
             self.base_arch.set_mode('classification')
@@ -83,9 +88,26 @@ class SeqClassNetwork(torch.nn.Module):
             self.chained_config = chained_config
         elif output == 'tree':
             self.output = mmo.SoftmaxTree(self.classes, tax_encoder, d_hidden)
- 
+
         self.to(utils.DEVICE)
 
+        # Allow TF32 tensor core matmuls on Ampere (or newer) GPUs
+        if (torch.cuda.is_available() and
+            torch.cuda.get_device_capability()[0] >= 8):
+            torch.set_float32_matmul_precision('high')
+            torch.backends.cudnn.allow_tf32 = True
+
+        # EncoderDecoder not supported (dynamic shapes in decoder loop)
+        self._compile_model = (compile_model and
+                               type(self.base_arch) != EncoderDecoder)
+        self._compiled_forward = None # Created lazily, excluded from pickles
+
+    def __getstate__(self):
+        '''Drops the compiled forward (which is unpicklable) from the state'''
+        state = self.__dict__.copy()
+        state['_compiled_forward'] = None
+        return state
+
     def _forward(self, x):
         x = self.base_arch(x) 
         for fcn_layer in self.fcn:
@@ -101,28 +123,42 @@ class SeqClassNetwork(torch.nn.Module):
     
     def _forward_autoregressive(self, x):
         '''Input decoder with prediction at previous token'''
-        # Initialize target with CLS token (=0 for decoder)
-        tgt = torch.zeros((x.shape[0],1), dtype=int, device=utils.DEVICE) 
+        # Run the encoder only once, its output is the same for all levels
+        src_mask = (x != utils.TOKENS['PAD']).unsqueeze(-2) # Mask padding
+        memory = self.base_arch.encode(x, src_mask)
+        # Preallocate target, first token is CLS (=0 for decoder)
+        tgt = torch.zeros((x.shape[0],7), dtype=int, device=utils.DEVICE)
+        tgt_mask = torch.ones((x.shape[0],1,7), dtype=torch.bool,
+                              device=utils.DEVICE)
+        # Stop decoding once all deeper levels are masked out anyway
+        masked = getattr(self, 'masked_levels', [])
+        last_lvl = max([lvl for lvl in range(6)
+                        if utils.LEVELS[lvl] not in masked], default=-1)
         output = []
-        for lvl in range(6):
-            x_ = self.base_arch(x, tgt)[:,lvl]
+        for lvl in range(last_lvl+1):
+            x_ = self.base_arch.decode(memory, src_mask, tgt[:,:lvl+1],
+                                       tgt_mask[:,:,:lvl+1])[:,lvl]
             x_ = self.output(x_, [lvl])
             output += x_
             pred = 1+self.tax_encoder.flat_label(torch.argmax(x_[0],dim=-1),lvl)
-            tgt = torch.cat((tgt, pred.unsqueeze(1)), dim=1)
+            tgt[:,lvl+1] = pred
+        for lvl in range(last_lvl+1, 6): # Zeros for masked trailing levels
+            output.append(torch.zeros((x.shape[0], self.classes[lvl]),
+                                      device=utils.DEVICE))
         return output
 
     def _forward_teacher_forcing(self, x, y):
         '''Input decoder with true target label'''
-        # Initialize target with CLS token (=0 for decoder)
-        tgt = torch.zeros((x.shape[0],1), dtype=int, device=utils.DEVICE) 
+        # Target is fully known, preallocate it before the loop
+        # (first token is CLS, =0 for decoder)
+        tgt = torch.zeros((x.shape[0],7), dtype=int, device=utils.DEVICE)
+        for lvl in range(6):
+            tgt[:,lvl+1] = 1 + self.tax_encoder.flat_label(y[:,lvl], lvl)
         output = []
-        for lvl in range(6): 
-            x_ = self.base_arch(x, tgt)[:,lvl]
+        for lvl in range(6):
+            x_ = self.base_arch(x, tgt[:,:lvl+1])[:,lvl]
             x_ = self.output(x_, [lvl])
             output += x_
-            next = 1 + self.tax_encoder.flat_label(y[:,lvl], lvl)
-            tgt = torch.cat((tgt, next.unsqueeze(1)), dim=1)
         return output
 
     def _forward_latent(self, x):
@@ -146,14 +182,18 @@ class SeqClassNetwork(torch.nn.Module):
         predictions = [pred_level.cpu().numpy() for pred_level in predictions]
         predictions = np.stack(predictions, axis=1)
         predictions = self.tax_encoder.decode(predictions)
+        mask_idx = getattr(self, '_masked_idx', None)
+        if mask_idx is None: # For models from old pickles
+            mask_idx = [utils.LEVELS.index(lvl) for lvl in self.masked_levels]
+        if len(mask_idx) > 0: # Mask in NumPy, before DataFrame construction
+            predictions[:,mask_idx] = utils.UNKNOWN_STR
         t1 = time.time()
-        
+
         if utils.VERBOSE > 0:
             print(f'Classification took {t1-t0} seconds.')
         classification = np.concatenate((ids, predictions), 1)
-        classification = pd.DataFrame(classification, 
+        classification = pd.DataFrame(classification,
                                       columns=['id'] + utils.LEVELS)
-        classification[self.masked_levels] = utils.UNKNOWN_STR
 
         if return_conf:
             confidence = [conf_level.cpu().numpy() for conf_level in confidence]
@@ -177,6 +217,7 @@ class SeqClassNetwork(torch.nn.Module):
         '''These levels will always return utils.UNKNOWN_STR in classification.
         Useful when model does not have a sufficient accuracy on a level.'''
         self.masked_levels = levels
+        self._masked_idx = [utils.LEVELS.index(lvl) for lvl in levels]
     
     def _predict(self, data, return_labels=False, return_conf=False):
         '''Returns predictions for entire dataset.
@@ -188,23 +229,61 @@ class SeqClassNetwork(torch.nn.Module):
         return_conf: bool
             Whether to include confidence score for prediction in return'''
 
+        self.finalize() # Materialize any lazy layers before inference
         dataloader = torch.utils.data.DataLoader(data, shuffle=False,
-                        batch_size=utils.PRED_BATCH_SIZE)
+                        batch_size=utils.PRED_BATCH_SIZE,
+                        num_workers=utils.NUM_WORKERS,
+                        pin_memory=(utils.DEVICE.type == 'cuda'),
+                        persistent_workers=(utils.NUM_WORKERS > 0))
         predictions = [[] for i in range(len(self.classes))]
         confidence = [[] for i in range(len(self.classes))]
         labels = []
-        
+
+        # Mixed precision
+        prec = torch.float16 if utils.DEVICE.type == 'cuda' else torch.bfloat16
+        # Compile the forward pass if requested (cached between calls)
+        forward = self
+        if getattr(self, '_compile_model', False):
+            if getattr(self, '_compiled_forward', None) is None:
+                self._compiled_forward = torch.compile(self._forward,
+                                                       mode='reduce-overhead')
+            forward = self._compiled_forward
+        # Indices of levels that classify() masks out, compute is skipped
+        masked = [utils.LEVELS.index(lvl)
+                  for lvl in getattr(self, 'masked_levels', [])]
+        # CUDA graph capture (opt-in), replays full-sized fixed-shape batches
+        use_graph = (utils.CUDA_GRAPHS and utils.DEVICE.type == 'cuda' and
+                     type(self.base_arch) != EncoderDecoder and forward is self)
+        graph = None
+
         with torch.no_grad():
             for (x,y) in dataloader:
-                x, y = x.to(utils.DEVICE), y.to(utils.DEVICE)
-                y_pred = self(x)
+                x = x.to(utils.DEVICE, non_blocking=True)
+                if use_graph and x.shape[0] == utils.PRED_BATCH_SIZE:
+                    if graph is None: # Warmup + capture on first full batch
+                        graph, static_x, static_y = \
+                                              self._capture_cuda_graph(x, prec)
+                    static_x.copy_(x, non_blocking=True)
+                    graph.replay()
+                    y_pred = static_y
+                else: # Eager fallback (e.g. for the last, smaller batch)
+                    with torch.autocast(device_type=utils.DEVICE.type,
+                                        dtype=prec,
+                                        enabled=utils.MIXED_PRECISION):
+                        y_pred = forward(x)
+                y_pred = [y_lvl.float() for y_lvl in y_pred]
                 for i in range(len(self.classes)):
+                    if i in masked: # Placeholders for masked levels
+                        predictions[i].append(
+                            torch.zeros(x.shape[0], dtype=torch.int64))
+                        confidence[i].append(torch.zeros(x.shape[0]))
+                        continue
                     conf, pred = torch.max(y_pred[i], dim=1)
-                    predictions[i].append(pred.cpu())
-                    confidence[i].append(conf.cpu())
-                labels.append(y.cpu())
-        predictions = [torch.cat(lvl) for lvl in predictions]
-        confidence = [torch.cat(lvl) for lvl in confidence]
+                    predictions[i].append(pred) # Stays on device until the
+                    confidence[i].append(conf) # end, avoids per-batch syncs
+                labels.append(y)
+        predictions = [torch.cat(lvl).cpu() for lvl in predictions]
+        confidence = [torch.cat(lvl).cpu() for lvl in confidence]
         labels = torch.cat(labels)
 
         if not return_labels and not return_conf:
@@ -217,6 +296,29 @@ class SeqClassNetwork(torch.nn.Module):
             else: 
                 return predictions, labels, confidence
         
+    def _capture_cuda_graph(self, x, prec):
+        '''Captures the forward pass for a batch shaped like x into a CUDA
+        graph, which can be replayed (with new input copied into the returned
+        static input tensor) to amortize kernel launch overhead.'''
+
+        static_x = x.clone()
+        stream = torch.cuda.Stream() # Warmup runs on a side stream
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for i in range(3):
+                with torch.autocast(device_type='cuda', dtype=prec,
+                                    enabled=utils.MIXED_PRECISION):
+                    static_y = self(static_x)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        # thread_local: dataloader (pin-memory) threads may touch CUDA during
+        # the capture window, which would invalidate a global-mode capture
+        with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+            with torch.autocast(device_type='cuda', dtype=prec,
+                                enabled=utils.MIXED_PRECISION):
+                static_y = self(static_x)
+        return graph, static_x, static_y
+
     def _encode_input_data(self, input_data, return_ids=False):
         '''Encodes a FASTA file/Data object into TensorData object.'''
 
@@ -246,14 +348,106 @@ class SeqClassNetwork(torch.nn.Module):
         self.eval()        
         input_data = self._encode_input_data(input_data)
         dataloader = torch.utils.data.DataLoader(input_data, shuffle=False,
-                                               batch_size=utils.PRED_BATCH_SIZE)
+                        batch_size=utils.PRED_BATCH_SIZE,
+                        num_workers=utils.NUM_WORKERS,
+                        pin_memory=(utils.DEVICE.type == 'cuda'),
+                        persistent_workers=(utils.NUM_WORKERS > 0))
+
+        # Mixed precision
+        prec = torch.float16 if utils.DEVICE.type == 'cuda' else torch.bfloat16
 
-        latent_repr = []
+        latent_repr, i = None, 0
         with torch.no_grad():
             for (x,y) in dataloader: # Loop through batches
-                x = x.to(utils.DEVICE)
-                latent_repr.append(self._forward_latent(x).cpu()) # Forward pass
-        return torch.cat(latent_repr).cpu().numpy() # Combine batches
+                x = x.to(utils.DEVICE, non_blocking=True)
+                with torch.autocast(device_type=utils.DEVICE.type, dtype=prec,
+                                    enabled=utils.MIXED_PRECISION):
+                    x = self._forward_latent(x) # Forward pass
+                x = x.float()
+                if latent_repr is None: # Preallocate (pinned) host buffer
+                    latent_repr = torch.empty((len(input_data), x.shape[1]),
+                                    pin_memory=(utils.DEVICE.type == 'cuda'))
+                # Stream batch to host buffer, overlaps with next forward pass
+                latent_repr[i:i+x.shape[0]].copy_(x, non_blocking=True)
+                i += x.shape[0]
+        if utils.DEVICE.type == 'cuda':
+            torch.cuda.synchronize() # Wait until async copies have finished
+        return latent_repr.numpy()
+
+    def _dummy_batch(self, batch_size=2):
+        '''Returns an arbitrary input batch, shaped like the encoded input.'''
+        encoding = self.dna_encoder.encode('ACGTACGTACGT')
+        return torch.stack([encoding]*batch_size).to(utils.DEVICE)
+
+    def finalize(self):
+        '''Materializes any uninitialized lazy layers by running a dummy batch
+        through the network, replacing them with regular layers that skip the
+        per-call initialization check. No-op if nothing is lazy anymore.'''
+
+        lazy = [module for module in self.modules()
+                if isinstance(module, torch.nn.modules.lazy.LazyModuleMixin)
+                and module.has_uninitialized_params()]
+        if len(lazy) == 0:
+            return
+        training = self.training
+        self.eval()
+        with torch.no_grad():
+            self(self._dummy_batch())
+        self.train(training)
+
+    def export_onnx(self, filepath, batch_size=2):
+        '''Exports the network to an ONNX file with a dynamic batch axis,
+        allowing accelerated inference through optimizing runtimes such as
+        ONNX Runtime or TensorRT. Not supported for EncoderDecoder-based
+        models, which require an autoregressive loop around the network.'''
+
+        if type(self.base_arch) == EncoderDecoder:
+            raise ValueError('ONNX export is not supported for ' +
+                             'EncoderDecoder base architectures.')
+        self.finalize() # Materialize any lazy layers before tracing
+        self.eval()
+        with torch.no_grad():
+            torch.onnx.export(self, self._dummy_batch(batch_size), filepath,
+                input_names=['sequences'], output_names=utils.LEVELS,
+                dynamic_axes={name: {0: 'batch'}
+                              for name in ['sequences'] + utils.LEVELS})
+
+    def fuse_for_inference(self):
+        '''Folds BatchNorm1d layers into the preceding Conv1d layers of the
+        base architecture (as found in e.g. ResNet), reducing the number of
+        operations and memory traffic at inference. The fused model should not
+        be trained any further.'''
+
+        self.eval()
+        for module in self.base_arch.modules():
+            if type(module) != torch.nn.Sequential:
+                continue
+            for i in range(len(module)-1):
+                if (type(module[i]) == torch.nn.Conv1d and
+                    type(module[i+1]) == torch.nn.BatchNorm1d):
+                    module[i] = torch.nn.utils.fusion.fuse_conv_bn_eval(
+                        module[i], module[i+1])
+                    module[i+1] = torch.nn.Identity()
+
+    def quantize_dynamic(self):
+        '''Quantizes the network's linear layers to INT8 for faster inference
+        on CPU, where these layers are memory-bandwidth-bound. Only available
+        when utils.DEVICE is the CPU. The quantized model should not be
+        trained any further.'''
+
+        if utils.DEVICE.type != 'cpu':
+            raise ValueError('Dynamic INT8 quantization is only supported on '+
+                             "CPU, call utils.set_device('cpu') first.")
+        self.eval()
+        self.finalize() # Materialize lazy layers so they get quantized too
+        if type(self.base_arch) == EncoderDecoder:
+            # The decoder loop slices the output head's weights per level,
+            # which quantized layers do not support; keep the head in fp32
+            self.base_arch = torch.ao.quantization.quantize_dynamic(
+                self.base_arch, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            torch.ao.quantization.quantize_dynamic(self, {torch.nn.Linear},
+                                               dtype=torch.qint8, inplace=True)
 
     def multi_to_infer_sum(self):
         '''Replaces the MultiHead output with InferSum, using the species-level
@@ -263,7 +457,14 @@ class SeqClassNetwork(torch.nn.Module):
             raise TypeError('self.output not of type MultiHead')
 
         new_head = mmo.InferSum(self.classes, self.tax_encoder, 'species')
-        new_head.fc1 = self.output.output[5]
+        # Extract the species-level slice from the fused MultiHead layer
+        fused = self.output.output
+        start, end = self.output.bounds[5], self.output.bounds[6]
+        species_head = torch.nn.Linear(fused.in_features, end-start)
+        with torch.no_grad():
+            species_head.weight.copy_(fused.weight[start:end])
+            species_head.bias.copy_(fused.bias[start:end])
+        new_head.fc1 = species_head
         new_head = new_head.to(utils.DEVICE)
         self.output = new_head
 
@@ -17,8 +17,10 @@ LEVELS = ['phylum', 'class', 'order', 'family', 'genus', 'species']
 UNKNOWN_STR = '?'
 UNKNOWN_INT = 9999999
 PRED_BATCH_SIZE = 64
+NUM_WORKERS = 0 # Set >0 to prepare batches in parallel with GPU compute
 MAX_PER_EPOCH = 250000
 MIXED_PRECISION = True
+CUDA_GRAPHS = False # Replay fixed-shape prediction batches as a CUDA graph
 WANDB_PROJECT = 'ITS Classification'
 MAX_LEN = 5000 # Max length of positional encodings transformers
 # NOTE Be careful with changing this one: BPE assumes TOKENS['MASK'] == 0 etc.